@@ -1,52 +1,142 @@
 import os
+import atexit
+import re
 import sys
-import subprocess
 import time
+import functools
+import itertools
+import importlib.util
+import shutil
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Иконка приложения: наличие файла проверяем один раз при запуске
+_ICON_PATH = Path('datas/logo.ico')
+_ICON_EXISTS = _ICON_PATH.exists()
 
 # Для Windows кодировки
 if sys.platform == 'win32':
     import codecs
     sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
 
+def env_int(name, default):
+    """Читает целое число >= 1 из переменной окружения"""
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+# Сколько ссылок скачивается одновременно (CLIPYSAVE_WORKERS, больше ~8
+# обычно упирается в лимиты сайтов)
+MAX_WORKERS = env_int('CLIPYSAVE_WORKERS', 4)
+
+# Сколько фрагментов одного видео качается одновременно (CLIPYSAVE_FRAGMENTS)
+FRAGMENT_WORKERS = env_int('CLIPYSAVE_FRAGMENTS', 8)
+
+# Сколько медиа одного поста Instagram качается одновременно
+MEDIA_WORKERS = 4
+
+# Дорожки YouTube до склейки держим в /dev/shm (Linux), если там свободно
+# хотя бы 2 ГБ на каждую загрузку, пишущую туда одновременно. Отключить: CLIPYSAVE_RAM_TEMP=0
+RAM_TEMP = os.environ.get('CLIPYSAVE_RAM_TEMP', '1') == '1'
+RAM_TEMP_MIN_FREE = 2 * 1024 ** 3
+
+# Не качать ссылки, уже скачанные в прошлых запусках (CLIPYSAVE_SKIP_SEEN=0 — качать заново)
+SKIP_SEEN = os.environ.get('CLIPYSAVE_SKIP_SEEN', '1') == '1'
+
+# Встраивать обложку и метаданные в видео YouTube (CLIPYSAVE_EMBED=1)
+EMBED_META = os.environ.get('CLIPYSAVE_EMBED', '0') == '1'
+
+# Размер буфера и куска при записи скачанных файлов (1 МБ)
+CHUNK_SIZE = 1 << 20
+
+# Прогресс пишут несколько потоков, печатаем по очереди
+_print_lock = threading.Lock()
+
+# Ctrl+C во время пачки: потоки загрузки проверяют флаг и прерываются
+_cancel = threading.Event()
+
+class DownloadCancelled(Exception):
+    """Загрузка прервана пользователем"""
+
+# Определение источника по ссылке (всё, что не распознано, считаем VK)
+_SOURCE_RE = re.compile(r'youtube\.com|youtu\.be|instagram\.com', re.IGNORECASE)
+_SOURCES = {
+    'youtube.com': 'YouTube',
+    'youtu.be': 'YouTube',
+    'instagram.com': 'Instagram',
+}
+
+# Короткий код поста Instagram: /p/, /reel/ или /tv/
+_IG_RE = re.compile(r'instagram\.com/(?:p|reel|tv)/([^/?#]+)', re.IGNORECASE)
+
+# Константы WinAPI для иконки консоли
+IMAGE_ICON = 1
+LR_LOADFROMFILE = 0x00000010
+WM_SETICON = 0x0080
+ICON_SMALL = 0
+ICON_BIG = 1
+
+@functools.lru_cache(maxsize=None)
+def winapi():
+    """Привязывает функции WinAPI при первом вызове и сразу задает типы аргументов,
+    чтобы ctypes не угадывал их на каждом вызове"""
+    import ctypes
+    from ctypes import wintypes
+    from types import SimpleNamespace
+    
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    user32 = ctypes.WinDLL('user32', use_last_error=True)
+    
+    GetConsoleWindow = kernel32.GetConsoleWindow
+    GetConsoleWindow.argtypes = []
+    GetConsoleWindow.restype = wintypes.HWND
+    
+    LoadImageW = user32.LoadImageW
+    LoadImageW.argtypes = [wintypes.HINSTANCE, wintypes.LPCWSTR, wintypes.UINT,
+                           ctypes.c_int, ctypes.c_int, wintypes.UINT]
+    LoadImageW.restype = wintypes.HICON
+    
+    SendMessageW = user32.SendMessageW
+    SendMessageW.argtypes = [wintypes.HWND, wintypes.UINT, wintypes.WPARAM, wintypes.HICON]
+    SendMessageW.restype = wintypes.LPARAM
+    
+    return SimpleNamespace(
+        GetConsoleWindow=GetConsoleWindow,
+        LoadImageW=LoadImageW,
+        SendMessageW=SendMessageW,
+    )
+
 def set_console_icon():
     """Устанавливает иконку для консоли (для Windows)"""
-    if sys.platform == 'win32':
-        try:
-            icon_path = Path('datas/logo.ico')
-            if icon_path.exists():
-                # Меняем заголовок окна
-                os.system(f'title VK/YouTube Downloader by @thetemirbolatov')
-                
-                # Для иконки в панели задач используем ctypes
-                import ctypes
-                # Получаем handle консоли
-                kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
-                user32 = ctypes.WinDLL('user32', use_last_error=True)
-                
-                # Находим окно консоли
-                console_handle = kernel32.GetConsoleWindow()
-                if console_handle:
-                    # Загружаем иконку из файла
-                    large_icon = ctypes.wintypes.HICON(
-                        user32.LoadImageW(
-                            0, str(icon_path.absolute()), 1,  # 1 = IMAGE_ICON
-                            32, 32, 0x00000010  # LR_LOADFROMFILE
-                        )
-                    )
-                    small_icon = ctypes.wintypes.HICON(
-                        user32.LoadImageW(
-                            0, str(icon_path.absolute()), 1,
-                            16, 16, 0x00000010
-                        )
-                    )
-                    
-                    # Устанавливаем иконки
-                    user32.SendMessageW(console_handle, 0x0080, 0, small_icon)  # WM_SETICON - small
-                    user32.SendMessageW(console_handle, 0x0080, 1, large_icon)  # WM_SETICON - large
-                    
-        except Exception as e:
-            pass  
+    if sys.platform != 'win32' or not _ICON_EXISTS:
+        return
+    
+    try:
+        api = winapi()
+        
+        # Меняем заголовок окна
+        os.system(f'title VK/YouTube Downloader by @thetemirbolatov')
+        
+        # Находим окно консоли
+        console_handle = api.GetConsoleWindow()
+        if console_handle:
+            icon_file = str(_ICON_PATH.absolute())
+            
+            # Загружаем иконку из файла
+            large_icon = api.LoadImageW(None, icon_file, IMAGE_ICON, 32, 32, LR_LOADFROMFILE)
+            small_icon = api.LoadImageW(None, icon_file, IMAGE_ICON, 16, 16, LR_LOADFROMFILE)
+            
+            # Устанавливаем иконки
+            if small_icon:
+                api.SendMessageW(console_handle, WM_SETICON, ICON_SMALL, small_icon)
+            if large_icon:
+                api.SendMessageW(console_handle, WM_SETICON, ICON_BIG, large_icon)
+            
+    except Exception as e:
+        pass  
 
 def show_logo():
     """Показывает логотип приложения"""
@@ -59,14 +149,110 @@ def show_logo():
     print('║     by @thetemirbolatov        ║')
     print('╚════════════════════════════════╝')
     
-    # Проверяем наличие иконки
-    icon_path = Path('datas/logo.ico')
-    if icon_path.exists():
-        print(f'📁 Иконка загружена: {icon_path}')
+    # Наличие иконки уже проверено при запуске
+    if _ICON_EXISTS:
+        print(f'📁 Иконка загружена: {_ICON_PATH}')
     else:
         print('📁 Создайте папку datas и добавьте logo.ico')
         
-def download_instagram(url):
+@functools.lru_cache(maxsize=None)
+def get_instaloader():
+    """Импортирует instaloader при первом обращении (он нужен только для Instagram)"""
+    import instaloader
+    return instaloader
+
+# Один Instaloader на всю программу: сессия, TLS и счетчики лимитов сохраняются
+_loader = None
+_loader_lock = threading.Lock()
+
+def get_loader():
+    """Возвращает общий экземпляр Instaloader, создавая его при первом вызове"""
+    global _loader
+    with _loader_lock:
+        if _loader is None:
+            instaloader = get_instaloader()
+            
+            # Instaloader нужен только для сессии и получения поста,
+            # сами файлы качаем напрямую
+            L = instaloader.Instaloader(
+                max_connection_attempts=3,
+                request_timeout=30.0,
+                quiet=True  # Меньше вывода
+            )
+            
+            # Подхватываем сохраненную сессию (instaloader --login), если есть
+            session_dir = Path(instaloader.instaloader.get_default_session_filename('')).parent
+            for session_file in session_dir.glob('session-*'):
+                try:
+                    username = session_file.name[len('session-'):]
+                    L.load_session_from_file(username, str(session_file))
+                    break
+                except Exception:
+                    continue
+            
+            # Пул соединений побольше: посты и медиа карусели качаются параллельно
+            # по тем же keep-alive соединениям. Размер пула — все одновременные
+            # запросы, иначе лишние соединения закрываются ("pool is full")
+            from requests.adapters import HTTPAdapter
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS * MEDIA_WORKERS)
+            L.context._session.mount('https://', adapter)
+            L.context._session.mount('http://', adapter)
+            
+            _loader = L
+        return _loader
+
+def reset_loader(L):
+    """Сбрасывает общий Instaloader, если это все еще он"""
+    global _loader
+    with _loader_lock:
+        if _loader is L:
+            _loader = None
+
+# Общий пул для медиа каруселей: до MEDIA_WORKERS файлов на каждый
+# из MAX_WORKERS одновременно качаемых постов
+_media_pool = None
+_media_pool_lock = threading.Lock()
+
+def get_media_pool():
+    """Возвращает общий пул потоков для медиа Instagram, создавая его при первом вызове"""
+    global _media_pool
+    with _media_pool_lock:
+        if _media_pool is None:
+            _media_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS * MEDIA_WORKERS,
+                                             thread_name_prefix='clipy-media')
+        return _media_pool
+
+def instagram_media(post):
+    """Возвращает список (ссылка, это_видео) для всех медиа поста"""
+    if post.typename == 'GraphSidecar':
+        return [
+            (node.video_url if node.is_video else node.display_url, node.is_video)
+            for node in post.get_sidecar_nodes()
+        ]
+    return [(post.video_url if post.is_video else post.url, post.is_video)]
+
+def save_media(session, url, path):
+    """Потоково сохраняет файл по ссылке, возвращает его размер в байтах"""
+    with session.get(url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        try:
+            with open(path, 'wb', buffering=CHUNK_SIZE) as f:
+                # Пишем кусками сами, чтобы между ними можно было прерваться
+                while True:
+                    if _cancel.is_set():
+                        raise DownloadCancelled()
+                    chunk = response.raw.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        except DownloadCancelled:
+            # Недокачанный файл не оставляем
+            path.unlink(missing_ok=True)
+            raise
+        # Сколько байт прочитано из ответа — столько и записано, stat не нужен
+        return response.raw.tell()
+
+def download_instagram(url, download_dir):
     """Скачивает с Instagram через instaloader"""
     print("\n[Instagram Downloader]")
     print("Начинаю загрузку...\n")
@@ -74,43 +260,17 @@ def download_instagram(url):
     try:
         # Пробуем импортировать instaloader
         try:
-            import instaloader
-            from instaloader import Post
+            instaloader = get_instaloader()
         except ImportError:
             print("❌ instaloader не установлен")
             print("Установите: pip install instaloader")
             return False
         
-        # Создаем экземпляр Instaloader без сохранения лишних файлов
-        L = instaloader.Instaloader(
-            download_videos=True,
-            download_video_thumbnails=False,
-            download_geotags=False,
-            download_comments=False,
-            save_metadata=False,  # Не сохранять JSON
-            compress_json=False,
-            post_metadata_txt_pattern='',  # Не создавать txt файлы
-            max_connection_attempts=3,
-            request_timeout=30.0,
-            quiet=True  # Меньше вывода
-        )
+        L = get_loader()
         
-        # Извлекаем короткий код из URL
-        import re
-        patterns = [
-            r'instagram\.com/p/([^/?]+)',
-            r'instagram\.com/reel/([^/?]+)',
-            r'instagram\.com/tv/([^/?]+)'
-        ]
-        
-        shortcode = None
-        for pattern in patterns:
-            match = re.search(pattern, url)
-            if match:
-                shortcode = match.group(1)
-                # Очищаем от лишних параметров
-                shortcode = shortcode.split('?')[0]
-                break
+        # Извлекаем короткий код из URL (параметры и якорь в него не попадают)
+        match = _IG_RE.search(url)
+        shortcode = match.group(1) if match else None
         
         if not shortcode:
             print("❌ Неверная ссылка Instagram")
@@ -120,7 +280,7 @@ def download_instagram(url):
         
         # Получаем пост по короткому коду
         try:
-            post = Post.from_shortcode(L.context, shortcode)
+            post = instaloader.Post.from_shortcode(L.context, shortcode)
             
             # Информация о посте
             if post.is_video:
@@ -138,49 +298,42 @@ def download_instagram(url):
             
             print("\n⏳ Скачивание...")
             
-            # Скачиваем пост
-            L.download_post(post, target='.')
-            
-            # Ищем скачанные файлы (видео или фото)
-            downloaded = False
-            current_dir = Path('.')
+            # Качаем только сами медиа напрямую, без download_post
+            # (он пишет метаданные и делает лишние запросы)
+            session = L.context._session
+            media = instagram_media(post)
+            names = [
+                (f'{shortcode}_{i}' if len(media) > 1 else shortcode) + ('.mp4' if is_video else '.jpg')
+                for i, (_, is_video) in enumerate(media, 1)
+            ]
             
-            # Ищем видео файлы
-            video_files = list(current_dir.glob(f'*{shortcode}*.mp4')) + \
-                         list(current_dir.glob(f'*{shortcode}*.mov'))
+            if len(media) == 1:
+                sizes = [save_media(session, media[0][0], download_dir / names[0])]
+            else:
+                # Медиа карусели качаем параллельно через общую сессию
+                # в общем пуле, а не в новом пуле на каждый пост
+                sizes = list(get_media_pool().map(
+                    lambda job: save_media(session, job[0], download_dir / job[1]),
+                    [(media_url, name) for (media_url, _), name in zip(media, names)]
+                ))
             
-            # Ищем фото файлы
-            photo_files = list(current_dir.glob(f'*{shortcode}*.jpg')) + \
-                         list(current_dir.glob(f'*{shortcode}*.png'))
+            _saved_local.files.extend(names)
             
-            # Удаляем JSON и txt файлы если они создались
-            for json_file in current_dir.glob(f'*{shortcode}*.json'):
-                json_file.unlink()
-            for txt_file in current_dir.glob(f'*{shortcode}*.txt'):
-                txt_file.unlink()
+            video_files = []
+            photo_files = []
+            for (_, is_video), name, size in zip(media, names, sizes):
+                (video_files if is_video else photo_files).append((name, size))
             
             # Показываем что скачалось
             if video_files:
                 print(f"\n✅ Скачано видео:")
-                for f in video_files:
-                    size = f.stat().st_size / (1024*1024)
-                    print(f"   📁 {f.name} ({size:.1f} MB)")
-                downloaded = True
+                for name, size in video_files:
+                    print(f"   📁 {name} ({size / (1024*1024):.1f} MB)")
             
             if photo_files:
                 print(f"\n✅ Скачано фото:")
-                for f in photo_files:
-                    size = f.stat().st_size / (1024*1024)
-                    print(f"   📁 {f.name} ({size:.1f} MB)")
-                downloaded = True
-            
-            if not downloaded:
-                print("\n⚠️ Файлы не найдены, но возможно скачались:")
-                all_files = list(current_dir.glob(f'*{shortcode}*'))
-                for f in all_files:
-                    size = f.stat().st_size / (1024*1024)
-                    print(f"   📁 {f.name} ({size:.1f} MB)")
-                    downloaded = True
+                for name, size in photo_files:
+                    print(f"   📁 {name} ({size / (1024*1024):.1f} MB)")
             
             print("\n✅ Загрузка завершена!")
             return True
@@ -192,8 +345,13 @@ def download_instagram(url):
             print("🔒 Приватный профиль. Нужна авторизация")
             return False
         except instaloader.exceptions.LoginRequiredException:
+            # Сессия устарела: в следующий раз создадим загрузчик заново
+            reset_loader(L)
             print("🔒 Требуется авторизация")
             return False
+        except DownloadCancelled:
+            print("\n❌ Загрузка отменена")
+            return False
         except Exception as e:
             print(f"❌ Ошибка при получении поста: {e}")
             return False
@@ -202,161 +360,532 @@ def download_instagram(url):
         print(f"\n❌ Ошибка: {e}")
         return False
 
-def download_media(url):
-    """Скачивает видео или музыку с VK или YouTube"""
+@functools.lru_cache(maxsize=1024)
+def detect_source(url):
+    """Определяет источник по ссылке"""
+    match = _SOURCE_RE.search(url)
+    if match:
+        return _SOURCES[match.group(0).lower()]
+    return 'VK'
+
+@functools.lru_cache(maxsize=None)
+def ram_temp_root():
+    """Папка этого процесса в /dev/shm, удаляется при выходе"""
+    temp_dir = f'/dev/shm/clipysave-{os.getpid()}'
+    atexit.register(shutil.rmtree, temp_dir, ignore_errors=True)
+    return temp_dir
+
+# Сколько загрузок сейчас пишут в /dev/shm
+_ram_temp_users = 0
+_ram_temp_lock = threading.Lock()
+
+def claim_ram_temp():
+    """Занимает место в /dev/shm под загрузку и возвращает папку,
+    или None, если места не хватает (тогда release_ram_temp не нужен)"""
+    global _ram_temp_users
+    if not RAM_TEMP or not sys.platform.startswith('linux'):
+        return None
+    with _ram_temp_lock:
+        # Уже идущие загрузки еще допишут свое, поэтому запас нужен на каждую
+        try:
+            if shutil.disk_usage('/dev/shm').free < RAM_TEMP_MIN_FREE * (_ram_temp_users + 1):
+                return None
+        except OSError:
+            return None
+        _ram_temp_users += 1
+    return ram_temp_root()
+
+def release_ram_temp():
+    """Освобождает место, занятое claim_ram_temp"""
+    global _ram_temp_users
+    with _ram_temp_lock:
+        _ram_temp_users -= 1
+
+def sweep_ram_temp():
+    """Удаляет папки в /dev/shm, оставшиеся от упавших запусков"""
+    if not sys.platform.startswith('linux'):
+        return
+    for temp_dir in Path('/dev/shm').glob('clipysave-*'):
+        try:
+            os.kill(int(temp_dir.name.partition('-')[2]), 0)
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            # Процесса уже нет, а RAM он занимает до перезагрузки
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        except OSError:
+            # Процесс жив, но чужой
+            pass
+
+def build_options(source, download_dir):
+    """Собирает параметры YoutubeDL для источника"""
+    # Базовые параметры
+    opts = {
+        'quiet': True,
+        'noprogress': True,  # Прогресс рисуем сами через хук
+        'restrictfilenames': True,
+        'outtmpl': '%(title)s.%(ext)s',
+        'paths': {'home': str(download_dir)},
+        'socket_timeout': 30,
+        'retries': 5,
+        'fragment_retries': 5,
+        'buffersize': CHUNK_SIZE,  # Начальный размер блока чтения/записи
+        # Фрагменты DASH/HLS (YouTube, VK) качаем параллельно
+        'concurrent_fragment_downloads': FRAGMENT_WORKERS,
+        'ignoreerrors': 'only_download',  # Ошибка одной ссылки не прерывает пачку
+        'logger': YtdlpLogger(),
+        'progress_hooks': [progress_hook],
+        'post_hooks': [saved_hook],
+    }
     
-    # Определяем источник
-    if 'youtube.com' in url or 'youtu.be' in url or 'm.youtube.com' in url:
-        source = 'YouTube'
-    elif 'instagram.com' in url:
-        return download_instagram(url)
+    # Настройки для разных источников
+    if source == 'VK':
+        opts.update({
+            'format': 'best[height<=1080]',
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36',
+                'Referer': 'https://vk.com/',
+            },
+        })
+        # Добавляем cookies для VK если есть (один stat вместо exists + stat)
+        cookie_file = download_dir / 'cookie.txt'
+        try:
+            if cookie_file.stat().st_size > 0:
+                opts['cookiefile'] = str(cookie_file)
+        except OSError:
+            pass
     else:
-        source = 'VK'
+        # Для YouTube лучшее качество до 1080p (4K обычно не нужен и качается дольше)
+        opts.update({
+            'format': 'bv*[height<=1080]+ba/b[height<=1080]/b',
+            'merge_output_format': 'mp4',
+            # Без фрагментов файл качается большими кусками по Range
+            'http_chunk_size': 10 * 1024 * 1024,
+        })
+        # Обложка и метаданные — лишняя загрузка и проход ffmpeg, только по запросу
+        if EMBED_META:
+            opts['writethumbnail'] = True
+            opts['postprocessors'] = [
+                {'key': 'FFmpegMetadata', 'add_metadata': True},
+                {'key': 'EmbedThumbnail', 'already_have_thumbnail': False},
+            ]
+        # Если установлен aria2c, отдаем загрузку ему (несколько соединений на файл)
+        if shutil.which('aria2c'):
+            opts['external_downloader'] = {'default': 'aria2c'}
+            opts['external_downloader_args'] = {'aria2c': ['-x', '8', '-s', '8', '-k', '1M']}
     
-    print(f"\n[{source} Downloader]")
-    print("Начинаю загрузку...\n")
+    return opts
+
+class YtdlpLogger:
+    """Показывает только прогресс и важные сообщения yt-dlp"""
+    
+    # Была ли ошибка с последнего сброса (run_ytdlp сбрасывает перед загрузкой)
+    failed = False
     
-    # Базовая команда
-    cmd = [
-        'yt-dlp',
-        '--progress',
-        '--newline',
-        '--no-part',
-        '--restrict-filenames',
-        '--output', '%(title)s.%(ext)s',
-        '--socket-timeout', '30',
-        '--retries', '5',
-        '--fragment-retries', '5',
+    def debug(self, msg):
+        if msg.startswith('[download] Destination'):
+            with _print_lock:
+                print(f'\n{msg}')
+        elif 'has already been downloaded' in msg:
+            with _print_lock:
+                print(f'\n✅ Файл уже скачан')
+    
+    # yt-dlp передает info-сообщения так же, как debug
+    info = debug
+    
+    def warning(self, msg):
+        if 'requested format not available' in msg:
+            return
+        with _print_lock:
+            print(f'\n⚠️ {msg}')
+    
+    def error(self, msg):
+        self.failed = True
+        with _print_lock:
+            if 'Video unavailable' in msg:
+                print(f'\n❌ Видео недоступно')
+            elif 'Private video' in msg:
+                print(f'\n🔒 Видео приватное')
+            else:
+                print(f'\n❌ {msg}')
+
+# Последний нарисованный процент и время отрисовки для каждого файла.
+# Не threading.local: при параллельных фрагментах yt-dlp вызывает хук
+# из своих потоков, и у каждого было бы свое состояние. Меняется под _print_lock
+_progress_state = {}
+
+# Не чаще 10 кадров в секунду
+PROGRESS_INTERVAL = 0.1
+
+# Готовые закодированные кадры прогресса на каждое число заполненных клеток
+BAR_LEN = 30
+_BAR_FRAMES = [
+    f'\r[{"█" * i}{"░" * (BAR_LEN - i)}] '.encode('utf-8')
+    for i in range(BAR_LEN + 1)
+]
+
+# Прогресс пишем байтами прямо в буфер stdout, минуя текстовый слой
+_stdout_bytes = getattr(sys.__stdout__, 'buffer', None)
+
+def progress_hook(d):
+    """Рисует прогресс бар по данным yt-dlp"""
+    if _cancel.is_set():
+        # Исключение из хука yt-dlp не глотает даже с ignoreerrors
+        from yt_dlp.utils import DownloadCancelled
+        raise DownloadCancelled()
+    
+    key = d.get('filename')
+    if d['status'] != 'downloading':
+        with _print_lock:
+            _progress_state.pop(key, None)
+        return
+    
+    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+    if not total:
+        return
+    
+    # Целый процент без float; перерисовываем только когда он меняется
+    p = min(int(d.get('downloaded_bytes', 0) * 100 // total), 100)
+    now = time.monotonic()
+    eta = d.get('eta')
+    
+    with _print_lock:
+        last_percent, last_draw = _progress_state.get(key, (None, 0.0))
+        if p == last_percent:
+            return
+        if p < 100 and now - last_draw < PROGRESS_INTERVAL:
+            return
+        _progress_state[key] = (p, now)
+        
+        frame = _BAR_FRAMES[BAR_LEN * p // 100] + b'%d%% ' % p
+        if eta is not None:
+            frame += b'%02d:%02d' % divmod(int(eta), 60)
+        
+        if _stdout_bytes is None:
+            print(frame.decode('utf-8'), end='', flush=True)
+            return
+        # Сначала выталкиваем то, что уже напечатано через print
+        sys.stdout.flush()
+        _stdout_bytes.write(frame)
+        _stdout_bytes.flush()
+
+# Имена файлов, сохраненных текущей загрузкой потока (для downloads/.seen)
+_saved_local = threading.local()
+
+def saved_hook(filename):
+    """Показывает итоговый путь файла после склейки и переноса"""
+    _saved_local.files.append(Path(filename).name)
+    with _print_lock:
+        print(f'\n📁 Сохранено: {filename}')
+
+# Экземпляры YoutubeDL переиспользуются между загрузками.
+# YoutubeDL не рассчитан на параллельные вызовы, поэтому кеш свой у каждого потока
+_ydl_local = threading.local()
+
+def get_ytdlp(source, download_dir):
+    """Возвращает закешированный YoutubeDL для источника"""
+    cache = getattr(_ydl_local, 'cache', None)
+    if cache is None:
+        cache = _ydl_local.cache = {}
+    ydl = cache.get(source)
+    if ydl is None:
+        from yt_dlp import YoutubeDL
+        ydl = cache[source] = YoutubeDL(build_options(source, download_dir))
+    return ydl
+
+# Параметры ссылки, которые нужны только для трекинга и не меняют видео
+_TRACKING_PARAMS = ('igsh', 'si', 'feature')
+
+# Уже скачанные ссылки (в том числе в прошлых запусках) с именами их файлов
+# и загрузки в процессе
+_seen = {}
+_seen_file = None
+_seen_pending = []
+_inflight = {}
+
+# Устаревшие строки .seen (ссылка скачана заново с другими файлами);
+# когда их наберется столько, файл переписывается целиком из _seen
+SEEN_COMPACT_AT = 100
+_seen_stale = 0
+_dedup_lock = threading.Lock()
+
+def normalize_url(url):
+    """Приводит ссылку к виду для сравнения: без трекинг-параметров и якоря"""
+    parts = urlsplit(url)
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in _TRACKING_PARAMS and not key.startswith('utm_')
     ]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'),
+                       urlencode(query), ''))
+
+def load_seen(download_dir):
+    """Загружает уже скачанные ссылки из downloads/.seen
+    (по одной на строку: ссылка и имена ее файлов через табуляцию)"""
+    global _seen_file, _seen_stale
+    _seen_file = download_dir / '.seen'
+    # На случай выхода посреди пачки
+    atexit.register(flush_seen)
+    try:
+        lines = _seen_file.read_text(encoding='utf-8').splitlines()
+    except OSError:
+        return
+    for line in filter(None, lines):
+        key, *files = line.split('\t')
+        if key in _seen:
+            _seen_stale += 1
+        _seen[key] = files
+
+def flush_seen():
+    """Дописывает в файл новые скачанные ссылки, а когда в нем накопилось
+    много устаревших строк — переписывает его целиком"""
+    global _seen_stale
+    with _dedup_lock:
+        if _seen_file is None or not _seen_pending:
+            return
+        try:
+            if _seen_stale >= SEEN_COMPACT_AT:
+                # Пишем во временный файл и подменяем, чтобы не потерять
+                # список, если запись оборвется
+                temp_file = _seen_file.with_name('.seen.tmp')
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    f.write(''.join('\t'.join((key, *files)) + '\n'
+                                    for key, files in _seen.items()))
+                os.replace(temp_file, _seen_file)
+                _seen_stale = 0
+            else:
+                with open(_seen_file, 'a', encoding='utf-8') as f:
+                    f.write(''.join('\t'.join(entry) + '\n' for entry in _seen_pending))
+            _seen_pending.clear()
+        except OSError:
+            pass
+
+def download_one(url, download_dir):
+    """Скачивает одну ссылку, выбирая загрузчик по источнику"""
+    global _seen_stale
+    # Одинаковые ссылки не качаем дважды: ни повторно, ни одновременно
+    try:
+        key = normalize_url(url)
+    except ValueError:
+        # Не разобрали — сравниваем как есть, ошибку покажет загрузчик
+        key = url
+    with _dedup_lock:
+        # Пропускаем, только пока файлы прошлой загрузки на месте
+        files = _seen.get(key)
+        if SKIP_SEEN and files and all((download_dir / name).exists() for name in files):
+            print(f'\n✅ Уже скачано ранее: {url}')
+            return True
+        event = _inflight.get(key)
+        owner = event is None
+        if owner:
+            event = _inflight[key] = threading.Event()
     
-    # Настройки для разных источников
-    if source == 'VK':
-        cmd.extend([
-            '--format', 'best[height<=1080]',
-            '--user-agent', 'Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36',
-            '--referer', 'https://vk.com/',
-        ])
-        # Добавляем cookies для VK если есть
-        cookie_file = Path('cookie.txt')
-        if cookie_file.exists() and cookie_file.stat().st_size > 0:
-            cmd.extend(['--cookies', 'cookie.txt'])
-    else:
-        # Для YouTube лучшее качество
-        cmd.extend([
-            '--format', 'bestvideo+bestaudio/best',
-            '--merge-output-format', 'mp4',
-            '--embed-thumbnail',
-            '--embed-metadata',
-        ])
+    if not owner:
+        # Эту ссылку уже качает другой поток, ждем его результат
+        event.wait()
+        return key in _seen
+    
+    ok = False
+    _saved_local.files = []
+    try:
+        # Пачку отменили, пока ссылка ждала своей очереди
+        if _cancel.is_set():
+            return False
+        
+        source = detect_source(url)
+        if source == 'Instagram':
+            ok = download_instagram(url, download_dir)
+        else:
+            ok = run_ytdlp(source, [url], download_dir)
+        return ok
+    finally:
+        with _dedup_lock:
+            files = _saved_local.files
+            if ok and _seen.get(key) != files:
+                # На диск пишем один раз после пачки, а не после каждой ссылки;
+                # прежняя строка этой ссылки в файле становится устаревшей
+                if key in _seen:
+                    _seen_stale += 1
+                _seen[key] = files
+                _seen_pending.append((key, *files))
+            elif not ok and key in _seen:
+                # Ждущие ту же ссылку потоки должны увидеть неудачу
+                del _seen[key]
+                _seen_stale += 1
+            del _inflight[key]
+        event.set()
+
+# Общий пул потоков на всю программу: потоки и их кеши YoutubeDL
+# (get_ytdlp) живут между пачками, а не создаются заново каждый раз
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Возвращает общий пул потоков загрузки, создавая его при первом вызове"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='clipy-dl')
+        return _pool
+
+def download_many(urls, download_dir):
+    """Скачивает пачку ссылок параллельно"""
+    # Папку создаем только когда действительно есть что скачивать
+    download_dir.mkdir(exist_ok=True)
     
-    cmd.append(url)
+    pending = set()
+    try:
+        # Потоков не больше, чем ссылок; при одном потоке качаем по очереди
+        workers = min(MAX_WORKERS, len(urls))
+        if workers == 1:
+            return all([download_one(url, download_dir) for url in urls])
+        
+        # Держим в работе не больше workers задач и подкидываем
+        # следующую ссылку по мере завершения предыдущих
+        pool = get_pool()
+        remaining = iter(urls)
+        pending = {pool.submit(download_one, url, download_dir)
+                   for url in itertools.islice(remaining, workers)}
+        ok = True
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                ok = future.result() and ok
+                url = next(remaining, None)
+                if url is not None:
+                    pending.add(pool.submit(download_one, url, download_dir))
+        
+        return ok
+    except KeyboardInterrupt:
+        # Не начатые ссылки снимаем, текущие прерываются через _cancel
+        _cancel.set()
+        print('\n\n❌ Загрузка отменена')
+        for future in pending:
+            future.cancel()
+        wait(pending)
+        return False
+    finally:
+        _cancel.clear()
+        flush_seen()
+
+def run_ytdlp(source, urls, download_dir):
+    """Скачивает список ссылок одного источника через yt-dlp"""
+    print(f"\n[{source} Downloader]")
+    print("Начинаю загрузку...\n")
     
     try:
-        # Запускаем процесс
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1,
-            encoding='utf-8',
-            errors='replace'
-        )
+        try:
+            ydl = get_ytdlp(source, download_dir)
+        except ImportError:
+            print("❌ yt-dlp не установлен")
+            print("Установите: pip install yt-dlp")
+            return False
         
-        # Отслеживаем прогресс
-        for line in process.stdout:
-            line = line.strip()
-            if not line:
-                continue
-            
-            # Показываем только прогресс и важные сообщения
-            if '[download]' in line:
-                if '%' in line:
-                    # Парсим процент
-                    try:
-                        parts = line.split()
-                        for part in parts:
-                            if '%' in part and part.replace('%', '').replace('.', '').isdigit():
-                                percent = part
-                                # Создаем прогресс бар
-                                p = float(percent.replace('%', ''))
-                                bar_len = 30
-                                filled = int(bar_len * p / 100)
-                                bar = '█' * filled + '░' * (bar_len - filled)
-                                print(f'\r[{bar}] {percent} {parts[-1] if len(parts) > 1 else ""}', end='', flush=True)
-                                break
-                    except:
-                        print(f'\r{line}', end='', flush=True)
-                elif 'Destination' in line:
-                    print(f'\n{line}')
-                elif 'has already been downloaded' in line:
-                    print(f'\n✅ Файл уже скачан')
-            elif 'ERROR:' in line:
-                if 'Video unavailable' in line:
-                    print(f'\n❌ Видео недоступно')
-                elif 'Private video' in line:
-                    print(f'\n🔒 Видео приватное')
-                else:
-                    print(f'\n❌ {line}')
-            elif 'WARNING:' in line:
-                if 'requested format not available' in line:
-                    continue
-                print(f'\n⚠️ {line}')
+        # Код возврата download() у переиспользуемого экземпляра "залипает"
+        # после первой ошибки, поэтому успех определяем сами: ошибок
+        # в логе не было и хотя бы один файл сохранен (saved_hook)
+        logger = ydl.params['logger']
+        logger.failed = False
         
-        process.wait()
+        # Дорожки YouTube до склейки держим в RAM; файл VK качается целиком
+        # сразу в папку загрузок и через /dev/shm гонять его незачем
+        temp_dir = claim_ram_temp() if source == 'YouTube' else None
+        if temp_dir:
+            ydl.params['paths']['temp'] = temp_dir
+        else:
+            ydl.params['paths'].pop('temp', None)
+        try:
+            ydl.download(urls)
+        finally:
+            if temp_dir:
+                release_ram_temp()
         
-        if process.returncode == 0:
+        if not logger.failed and _saved_local.files:
             print('\n\n✅ Загрузка завершена!')
             return True
         else:
-            print(f'\n❌ Ошибка загрузки (код: {process.returncode})')
+            print('\n❌ Ошибка загрузки')
             return False
             
     except KeyboardInterrupt:
+        # При последовательной загрузке Ctrl+C приходит сюда: остальные
+        # ссылки пачки тоже не качаем
+        _cancel.set()
         print('\n\n❌ Загрузка отменена')
-        if 'process' in locals():
-            process.terminate()
         return False
     except Exception as e:
+        if _cancel.is_set():
+            print('\n❌ Загрузка отменена')
+            return False
         print(f'\n❌ Ошибка: {e}')
         return False
 
 def main():
-    # Создаем папку downloads
-    download_dir = Path('downloads')
-    download_dir.mkdir(exist_ok=True)
+    # Папка downloads. Путь абсолютный: загрузчики получают его явно
+    # и не зависят от текущей папки процесса. Сама папка создается
+    # только перед загрузкой (download_many)
+    download_dir = Path('downloads').absolute()
+    load_seen(download_dir)
+    sweep_ram_temp()
+    
+    # Быстрый путь: ссылки переданы в командной строке
+    # (python ClipySave.py URL [URL ...]) — качаем сразу, без меню
+    urls = sys.argv[1:]
+    if urls and all(url.startswith(('http://', 'https://')) for url in urls):
+        return 0 if download_many(urls, download_dir) else 1
     
     print('╔════════════════════════════════╗')
     print('║     ClipySave  v1.0            ║')
     print('║     by @thetemirbolatov        ║')
     print('╚════════════════════════════════╝')
     
+    if not EMBED_META:
+        print('🖼️ Обложка и метаданные не встраиваются (включить: CLIPYSAVE_EMBED=1)')
+    
+    # yt-dlp импортируется только при первой загрузке (это долго),
+    # а здесь лишь проверяем, что он установлен
+    if importlib.util.find_spec('yt_dlp') is None:
+        print('\n⚠️ yt-dlp не установлен, YouTube и VK работать не будут')
+        print('Установите: pip install yt-dlp')
+    
     while True:
         print('\n📁 Файлы сохраняются в папку: downloads/')
-        url = input('\n🔗 Вставьте ссылку (или "exit"): ').strip()
+        print('\n🔗 Вставьте ссылки по одной на строку, пустая строка — начать загрузку (или "exit")')
         
-        if url.lower() in ['exit', 'quit', 'q', 'выход']:
-            print('\n👋 До свидания!')
-            break
+        # Копим ссылки до пустой строки; повторы и комментарии (#) пропускаем
+        urls = []
+        pasted = set()
+        while True:
+            url = input('🔗 ').strip()
+            if url.lower() in ['exit', 'quit', 'q', 'выход']:
+                print('\n👋 До свидания!')
+                return
+            if not url:
+                break
+            if url.startswith('#'):
+                continue
+            try:
+                key = normalize_url(url)
+            except ValueError:
+                # Битая ссылка (например, "http://[::1") не должна ронять программу
+                print(f'❌ Неверная ссылка: {url}')
+                continue
+            if key not in pasted:
+                pasted.add(key)
+                urls.append(url)
         
-        if not url:
+        if not urls:
             print('❌ Введите ссылку')
             continue
         
-        # Переходим в папку downloads
-        os.chdir('downloads')
-        
-        # Скачиваем
-        download_media(url)
-        
-        # Возвращаемся обратно
-        os.chdir('..')
+        # Скачиваем всю пачку в папку downloads
+        download_many(urls, download_dir)
         
         print('\n' + '─' * 40)
 
 if __name__ == '__main__':
     try:
-        main()
+        sys.exit(main())
     except KeyboardInterrupt:
         print('\n\n👋 Программа завершена')
     except Exception as e:
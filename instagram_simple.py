@@ -18,8 +18,11 @@ if result.success:
     print(f"\n✅ Instagram контент скачан!")
     print("📁 Файлы сохранены:")
     for file in result.files:
-        if file.exists():
+        # Один stat вместо exists() + stat()
+        try:
             size_mb = file.stat().st_size / (1024 * 1024)
-            print(f"   📄 {file.name} ({size_mb:.1f} MB)")
+        except OSError:
+            continue
+        print(f"   📄 {file.name} ({size_mb:.1f} MB)")
 else:
     print(f"❌ Ошибка: {result.error}")
\ No newline at end of file